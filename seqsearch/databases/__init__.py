@@ -8,7 +8,7 @@ Contact at www.sinclair.bio
 """
 
 # Built-in modules #
-import os, fnmatch
+import os, shutil, fnmatch
 from collections import OrderedDict, Counter
 
 # First party modules #
@@ -87,7 +87,9 @@ class Database:
         # Loop over files #
         for source, dest in tqdm(self.files_remaining.items()):
             dest.remove()
-            self.ftp.download(source, dest)
+            # Binary transfer with large blocks #
+            with self.ftp.open(source, 'rb') as remote, open(dest, 'wb') as local:
+                shutil.copyfileobj(remote, local, 1<<20)
             dest.permissions.only_readable()
 
     @property
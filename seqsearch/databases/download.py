@@ -8,22 +8,139 @@ Contact at www.sinclair.bio
 """
 
 # Built-in modules #
+import os, io, dbm, time, shelve, hashlib, warnings, threading, contextlib
+from urllib.error import HTTPError, URLError
+from concurrent.futures import ThreadPoolExecutor
 
 # Internal modules #
 
 # Third party modules #
+from tqdm import tqdm
+
+# Requests from all the threads share one rate limit #
+request_lock = threading.Lock()
+last_request = 0.0
 
 ###############################################################################
-def acc_to_fasta(accessions):
+def acc_to_fasta(accessions, chunk_size=400, cache_path=None):
     """
     Pass a list of accessions IDs as argument and a string representing
     a FASTA is returned.
+    Long lists are fetched in chunks of `chunk_size` IDs, several chunks at
+    the same time. NCBI allows three requests per second, or ten if you
+    set an API key in the `NCBI_API_KEY` environment variable. The
+    requests of all the threads are spaced out to respect that limit.
+    If you give a `cache_path`, the answers of NCBI are kept in a cache on
+    disk there, so that chunks already fetched by a previous call are never
+    downloaded again. Pass `True` to use '~/.cache/seqsearch/entrez'. The
+    cache can't be shared by several processes running at the same time,
+    so it is off by default.
+    """
+    from Bio import Entrez
+    Entrez.email   = "I don't know who will be running this script"
+    Entrez.api_key = os.environ.get('NCBI_API_KEY')
+    # Cut the list #
+    if isinstance(accessions, str): accessions = [accessions]
+    chunks = [accessions[i:i+chunk_size] for i in range(0, len(accessions), chunk_size)]
+    keys   = [hashlib.sha1(','.join(c).encode()).hexdigest() for c in chunks]
+    # The cache on disk, only if asked for #
+    if cache_path is True:
+        cache_path = os.path.expanduser('~/.cache/seqsearch/entrez')
+    cache = contextlib.nullcontext({})
+    if cache_path:
+        os.makedirs(os.path.dirname(os.path.abspath(cache_path)), exist_ok=True)
+        try:
+            cache = shelve.open(cache_path)
+        except dbm.error as error:
+            msg = "Can't open the cache at '%s' (%s), continuing without it."
+            warnings.warn(msg % (cache_path, error), RuntimeWarning)
+    # Only the shelf is not thread safe, so only this thread touches it #
+    with cache as stored:
+        missing = [(k, c) for k, c in zip(keys, chunks) if k not in stored]
+        # Fetch the missing chunks in parallel #
+        records = {}
+        workers = 10 if Entrez.api_key else 3
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = executor.map(fetch_chunk, [c for k, c in missing])
+            results = tqdm(results, total=len(missing), disable=len(missing) < 2)
+            for (key, chunk), (raw, parsed) in zip(missing, results):
+                stored[key]  = raw
+                records[key] = parsed
+        # Put everything back in order #
+        for key in keys:
+            if key in records: continue
+            # Older caches kept a single page per chunk #
+            pages = stored[key]
+            if isinstance(pages, bytes): pages = [pages]
+            records[key] = [r for page in pages for r in Entrez.read(io.BytesIO(page))]
+        return [record for key in keys for record in records[key]]
+
+def fetch_chunk(accessions, attempts=12, post_above=2000, page_size=5000):
+    """
+    Fetch the records of one chunk of accessions from NCBI.
+    Returns both the raw XML answers, one per page, and the records parsed
+    from them.
+    Chunks of more than `post_above` IDs are first uploaded to the
+    Entrez history server with `epost` and then fetched by reference,
+    as NCBI recommends for long lists. The records might then come back
+    in a different order. As NCBI never returns more than 10,000 records
+    at once, they are fetched in pages of `page_size`.
+    Every request is tried up to `attempts` times, see `with_retries`.
+    """
+    from Bio import Entrez
+    # Download one page of records and parse it #
+    def fetch(**which):
+        wait_for_turn()
+        with Entrez.efetch(db      = "nuccore",
+                           rettype = "fasta",
+                           retmode = "xml",
+                           **which) as entries:
+            raw = entries.read()
+        return raw, Entrez.read(io.BytesIO(raw))
+    # Upload a long list to the history server #
+    def post():
+        wait_for_turn()
+        with Entrez.epost(db="nuccore", id=','.join(accessions)) as posted:
+            return Entrez.read(posted)
+    # Which records to fetch #
+    if len(accessions) > post_above:
+        posted = with_retries(post, attempts)
+        pages  = [with_retries(lambda: fetch(webenv    = posted['WebEnv'],
+                                             query_key = posted['QueryKey'],
+                                             retstart  = start,
+                                             retmax    = page_size), attempts)
+                  for start in range(0, len(accessions), page_size)]
+    else:
+        pages = [with_retries(lambda: fetch(id=accessions), attempts)]
+    # Return #
+    raw     = [raw for raw, records in pages]
+    records = [record for raw, records in pages for record in records]
+    return raw, records
+
+def wait_for_turn():
+    """
+    Block until this thread may send the next request to NCBI. The threads
+    take turns under a lock, so that they can't all compute the same wait
+    and then send at the same moment.
     """
+    global last_request
     from Bio import Entrez
-    Entrez.email = "I don't know who will be running this script"
-    entries = Entrez.efetch(db      = "nuccore",
-                            id      = accessions,
-                            rettype = "fasta",
-                            retmode = "xml")
-    records = Entrez.read(entries)
-    return records
\ No newline at end of file
+    delay = 0.1 if Entrez.api_key else 0.34
+    with request_lock:
+        wait = last_request + delay - time.monotonic()
+        if wait > 0: time.sleep(wait)
+        last_request = time.monotonic()
+
+def with_retries(function, attempts=12):
+    """
+    Call `function` and return its result. If NCBI fails to answer, it is
+    called again up to `attempts` times, waiting 0.5s, 1s, 2s... and at
+    most one minute in between.
+    """
+    from Bio.Entrez.Parser import CorruptedXMLError
+    for attempt in range(attempts):
+        try:
+            return function()
+        except (HTTPError, URLError, CorruptedXMLError):
+            if attempt == attempts - 1: raise
+            time.sleep(min(60, 0.5 * 2 ** attempt))
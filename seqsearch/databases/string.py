@@ -8,7 +8,7 @@ Contact at www.sinclair.bio
 """
 
 # Built-in modules #
-import urllib
+import os, hashlib, urllib.request, urllib.error
 from collections import OrderedDict
 
 # Internal modules #
@@ -18,6 +18,7 @@ from seqsearch.databases import base_directory
 from fasta import FASTA
 from autopaths.auto_paths import AutoPaths
 from autopaths.file_path import FilePath
+from plumbing.cache import property_cached
 
 ###############################################################################
 class String(object):
@@ -27,6 +28,7 @@ class String(object):
     """
 
     base_url = "http://string.embl.de/newstring_download/"
+    checksums_url = base_url + "md5checksums.txt"
     short_name = "string"
 
     all_paths = """
@@ -34,6 +36,7 @@ class String(object):
     /raw/cog_mappings.tsv.gz
     /unzipped/all_proteins.fasta
     /unzipped/cog_mappings.tsv
+    /recompressed/all_proteins.fasta.zst
     /blast_db/all_proteins.fasta
     /blast_db/all_proteins.fasta.00.pin
     /blast_db/logfile.txt
@@ -53,34 +56,108 @@ class String(object):
         result[self.base_url + "COG.mappings.v9.1.txt.gz"]     = FilePath(self.p.raw_mappings)
         return result
 
+    @property_cached
+    def checksums(self):
+        """
+        The MD5 digests published on the server, as a dictionary of file
+        names to hex digests. Empty if the server doesn't provide any.
+        """
+        try: response = urllib.request.urlopen(self.checksums_url)
+        except urllib.error.URLError: return {}
+        with response: lines = response.read().decode().splitlines()
+        return {os.path.basename(name): digest
+                for digest, name in (line.split() for line in lines if line.strip())}
+
+    @staticmethod
+    def md5(path):
+        """Compute the MD5 hex digest of a local file."""
+        with open(path, 'rb') as handle:
+            if hasattr(hashlib, 'file_digest'):
+                return hashlib.file_digest(handle, 'md5').hexdigest()
+            digest = hashlib.md5()
+            for block in iter(lambda: handle.read(1<<20), b''): digest.update(block)
+            return digest.hexdigest()
+
+    def is_intact(self, source, dest):
+        """
+        Check a downloaded file against its published MD5 digest, or
+        against the remote size if there is no digest for it.
+        """
+        if not dest.exists: return False
+        expected = self.checksums.get(os.path.basename(source))
+        if expected is not None: return self.md5(dest) == expected
+        with urllib.request.urlopen(source) as response:
+            return dest.count_bytes == int(response.headers['Content-Length'])
+
     @property
     def files_remaining(self):
-        """The files we haven't downloaded yet based on size checks."""
-        get_size_http = lambda url: urllib.urlopen(url).info().getheaders("Content-Length")[0]
+        """The files we haven't downloaded yet or that are corrupted."""
         return OrderedDict((source, dest) for source, dest in self.files_to_retrieve.items()
-                           if dest.count_bytes != get_size_http(source))
+                           if not self.is_intact(source, dest))
 
     def download(self):
         """Retrieve all files from the website"""
         for source, dest in self.files_remaining.items():
             dest.remove()
-            urllib.urlretrieve(source, dest)
+            urllib.request.urlretrieve(source, dest)
             dest.permissions.only_readable()
 
     @property
     def raw_files(self):
-        """The files we have downloaded."""
-        return map(FilePath, self.p.raw_dir.contents)
+        """
+        The files we have downloaded. A single `scandir` call lists the
+        directory and tells us which entries are files without an extra
+        `stat` per entry.
+        """
+        return (FilePath(entry.path) for entry in os.scandir(self.p.raw_dir)
+                if entry.is_file())
 
     def unzip(self):
         """Unzip them"""
         for f in self.raw_files: f.ungzip_to(self.p.unzipped_dir + f.prefix)
 
+    def recompress(self, level=19, remove_original=False):
+        """
+        Recompress the unzipped proteins with zstandard in long-range mode.
+        This roughly halves the space they take on disk while staying cheap
+        to decompress. Requires the `zstandard` package.
+        """
+        import zstandard
+        params = zstandard.ZstdCompressionParameters.from_level(level,
+                                                                window_log = 27,
+                                                                enable_ldm = True,
+                                                                threads    = -1)
+        compressor = zstandard.ZstdCompressor(compression_params=params)
+        self.p.zst.directory.create_if_not_exists()
+        with open(self.p.unzipped_proteins, 'rb') as source, \
+             open(self.p.zst, 'wb') as dest:
+            compressor.copy_stream(source, dest, read_size=1<<20, write_size=1<<20)
+        self.p.zst.permissions.only_readable()
+        if remove_original: self.p.unzipped_proteins.remove()
+
     @property
     def all_proteins(self):
         """The main fasta file."""
         return FASTA(self.p.unzipped_proteins)
 
+    @property
+    def sequences(self):
+        """
+        All the proteins, read from the uncompressed fasta if it is present,
+        otherwise streamed out of the zstandard copy made by `recompress`.
+        """
+        # The plain file is still here #
+        if self.p.unzipped_proteins.exists:
+            for seq in self.all_proteins: yield seq
+            return
+        # Stream decompress #
+        import io, zstandard
+        from Bio import SeqIO
+        with open(self.p.zst, 'rb') as handle:
+            reader = zstandard.ZstdDecompressor().stream_reader(handle)
+            text   = io.TextIOWrapper(io.BufferedReader(reader, 1<<20))
+            for seq in SeqIO.parse(text, 'fasta'): yield seq
+
     @property
     def mappings(self):
         """The cog mappings."""
@@ -8,7 +8,7 @@ Contact at www.sinclair.bio
 """
 
 # Built-in modules #
-import multiprocessing
+import os, re, shutil, multiprocessing
 
 # First party modules #
 from seqsearch.search.blast   import BLASTquery, BLASTdb
@@ -16,6 +16,8 @@ from seqsearch.search.vsearch import VSEARCHquery
 from seqsearch.search.hmmer   import HmmQuery
 from plumbing.cache           import property_cached
 from autopaths.file_path      import FilePath
+from autopaths.tmp_path       import new_temp_path
+from fasta                    import FASTA
 
 ################################################################################
 class SeqSearch(object):
@@ -92,9 +94,9 @@ class SeqSearch(object):
             self.database = self.database.blast_db
         if self.algorithm == 'vsearch' and hasattr(self.database, 'vsearch_db'):
             self.database = self.database.vsearch_db
-        # Otherwise in case we got a path, convert it to a BLASTdb #
+        # Otherwise in case we got a path, convert it to a BLASTdb once #
         if self.algorithm == 'blast' and not isinstance(self.database, BLASTdb):
-            self.database = BLASTdb(self.database)
+            self.database = BLASTdb(self.database, self.seq_type)
         # The filtering options #
         if self.filtering is None: self.filtering = {}
         # Output path default value #
@@ -183,6 +185,80 @@ class SeqSearch(object):
                           _out       = self._out,
                           _err       = self._err)
 
+    def blast_batched(self, inputs, out_paths=None):
+        """
+        Search several FASTA files against the database with one single
+        BLAST invocation, so that the database is loaded and indexed only
+        once, then split the results back into one output per input.
+        The output is forced to the commented tabular format ('-outfmt 7',
+        keeping any column specification) as its '# Query:' lines tell us
+        where the hits of each query begin.
+        Returns the list of output paths, one per input.
+        """
+        # Default output paths #
+        if out_paths is None:
+            out_paths = [i.prefix_path + '.' + self.algorithm + 'out' for i in inputs]
+        out_paths = [FilePath(p) for p in out_paths]
+        # Remember which input every sequence came from #
+        origin = {}
+        for i, fasta in enumerate(inputs):
+            for seq in fasta:
+                if seq.id in origin:
+                    msg = "The sequence '%s' appears in both '%s' and '%s'."
+                    raise Exception(msg % (seq.id, inputs[origin[seq.id]], fasta))
+                origin[seq.id] = i
+        # Concatenate the inputs #
+        combined = FASTA(new_temp_path())
+        with open(combined, 'wb') as dest:
+            for fasta in inputs:
+                with open(fasta, 'rb') as source:
+                    shutil.copyfileobj(source, dest, 1 << 20)
+                    # Don't glue the next record onto the last sequence #
+                    if source.tell():
+                        source.seek(-1, os.SEEK_END)
+                        if source.read(1) != b'\n': dest.write(b'\n')
+        # Force commented tabular output #
+        params = self.blast_params.copy()
+        outfmt = str(params.get('-outfmt', '7')).strip('"').split()
+        params['-outfmt'] = ' '.join(['7'] + outfmt[1:])
+        # Run one search on everything #
+        query = BLASTquery(query_path = combined,
+                           db_path    = self.database,
+                           seq_type   = self.seq_type,
+                           params     = params,
+                           algorithm  = self.select_blast_algo(),
+                           cpus       = self.num_threads,
+                           out_path   = new_temp_path(),
+                           _out       = self._out,
+                           _err       = self._err)
+        query.run()
+        # Split the results, each block starts with the program name #
+        program = re.compile(r'^# T?BLAST[NPX] ')
+        handles = [open(path, 'w') for path in out_paths]
+        try:
+            current, pending = None, []
+            with open(query.out_path) as results:
+                for line in results:
+                    if program.match(line):
+                        pending = [line]
+                    elif line.startswith('# Query: '):
+                        current = handles[origin[line[9:].split()[0]]]
+                        current.writelines(pending + [line])
+                        pending = []
+                    elif line.startswith('# BLAST processed'):
+                        continue
+                    elif current is None:
+                        pending.append(line)
+                    else:
+                        current.write(line)
+        finally:
+            for handle in handles: handle.close()
+        # Clean up #
+        combined.remove()
+        query.out_path.remove()
+        # Return #
+        return out_paths
+
     #------------------------- VSEARCH IMPLEMENTATION ------------------------#
     @property_cached
     def vsearch_params(self):
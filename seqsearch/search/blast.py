@@ -8,11 +8,17 @@ Contact at www.sinclair.bio
 """
 
 # Built-in modules #
-import os, shutil
+import os, re, csv, mmap, shutil, subprocess, tempfile
+from itertools import chain
+
+# Not available on Windows #
+try: import fcntl
+except ImportError: fcntl = None
 
 # First party modules #
 from fasta import FASTA
 from autopaths.tmp_path  import new_temp_path
+from plumbing.cache      import property_cached
 
 # Internal modules #
 from seqsearch.search.core import CoreSearch
@@ -44,57 +50,166 @@ class BLASTquery(CoreSearch):
 
     extension = 'blastout'
 
-    def __init__(self, *args, **kwargs):
+    # The version of every BLAST program already asked, by name or path #
+    versions = {}
+
+    # The columns of the tabular output formats when none are specified #
+    std_columns = ['qaccver', 'saccver', 'pident', 'length', 'mismatch', 'gapopen',
+                   'qstart', 'qend', 'sstart', 'send', 'evalue', 'bitscore']
+
+    def __init__(self, query_path, db_path, *args, **kwargs):
         # Parent constructor #
-        super(BLASTquery, self).__init__(*args, **kwargs)
-        # Auto detect XML output #
-        if self.out_path.extension == 'xml': self.params['-outfmt'] = '5'
-        # The database to search against #
-        self.db = BLASTdb(self.db, self.seq_type)
+        super(BLASTquery, self).__init__(query_path, db_path, *args, **kwargs)
+        # Our own copy of the options, as strings once and for all #
+        self.params = {str(k): str(v) for k, v in self.params.items()}
+        # Auto detect XML or single file JSON output #
+        if self.out_path.extension == 'xml':  self.params['-outfmt'] = '5'
+        if self.out_path.extension == 'json': self.params['-outfmt'] = '15'
+        # The database to search against, unless it is one already #
+        if isinstance(db_path, BLASTdb): self.db = db_path
+        else:                            self.db = BLASTdb(self.db, self.seq_type)
+
+    @property
+    def exe(self):
+        """The name or path of the BLAST program to call."""
+        if self.executable: return str(self.executable)
+        else:               return self.algorithm
+
+    @property
+    def version(self):
+        """
+        The version of the BLAST program as a tuple of integers such as
+        (2, 12, 0), or None if it can't be determined. Each program is only
+        asked once, the answer is shared by all instances.
+        """
+        exe = self.exe
+        if exe not in BLASTquery.versions:
+            try:
+                result = subprocess.run([exe, '-version'],
+                                        stdout = subprocess.PIPE,
+                                        stderr = subprocess.DEVNULL,
+                                        text   = True)
+                found  = re.search(r'(\d+)\.(\d+)\.(\d+)\+', result.stdout)
+            except OSError:
+                found  = None
+            BLASTquery.versions[exe] = tuple(map(int, found.groups())) if found else None
+        return BLASTquery.versions[exe]
 
     @property
+    def query_threading(self):
+        """
+        Should BLAST share its threads out by query instead of by database
+        ('-mt_mode 1')? This scales much better, but only exists since
+        version 2.12 and only pays off when there are more queries than
+        threads. The option is left alone if it was given explicitly.
+        """
+        if self.cpus <= 1 or '-mt_mode' in self.params: return False
+        if (self.version or (0,)) < (2, 12):            return False
+        return self.query.exists and self.query.count > self.cpus
+
+    @property_cached
     def command(self):
-        # Executable #
-        if self.executable: cmd = [str(self.executable)]
-        else:               cmd = [self.algorithm]
-        # Other parameters
-        cmd += ['-db',          self.db,
-                '-query',       self.query,
-                '-out',         self.out_path,
-                '-num_threads', self.cpus]
+        # Other parameters #
+        cmd = [self.exe, '-db',          str(self.db),
+                         '-query',       str(self.query),
+                         '-out',         str(self.out_path),
+                         '-num_threads', str(self.cpus)]
+        # Thread by query when worth it #
+        if self.query_threading: cmd += ['-mt_mode', '1']
         # Options #
-        for k,v in self.params.items(): cmd += [k, v]
-        # Return #
-        return list(map(str, cmd))
+        cmd.extend(chain.from_iterable(self.params.items()))
+        # Return, immutable as it is cached #
+        return tuple(cmd)
 
     #-------------------------------- RUNNING --------------------------------#
     def run(self, verbose=False):
         """Simply run the BLAST search locally."""
+        # The command is only built once #
+        command = self.command
         # Check the executable is available #
-        if self.executable:
-            self.executable.must_exist()
-        else:
-            from plumbing.check_cmd_found import check_cmd
-            check_cmd(self.command[0])
+        self.check_executable()
         # Create the output directory if it doesn't exist #
         self.out_path.directory.create_if_not_exists()
         # Optionally print the command #
         if verbose:
-            print("Running BLAST command:\n    %s" % ' '.join(self.command))
+            print("Running BLAST command:\n    %s" % ' '.join(command))
         # Run it #
-        cmd    = sh.Command(self.command[0])
-        result = cmd(self.command[1:], _out=self._out, _err=self._err)
+        result = self.launch(command)
         # Clean up #
         if os.path.exists("error.log") and os.path.getsize("error.log") == 0:
             os.remove("error.log")
         # Return #
         return result
 
+    def check_executable(self):
+        """Raise an exception if the BLAST executable can't be found."""
+        if self.executable:
+            self.executable.must_exist()
+        else:
+            from plumbing.check_cmd_found import check_cmd
+            check_cmd(self.command[0])
+
+    def run_and_filter(self, filtering, verbose=False):
+        """
+        Same as calling `run` and then `filter`, except that the output of
+        BLAST is read through a pipe and filtered while it is produced.
+        The unfiltered results never touch the disk.
+        """
+        # Thresholds and columns #
+        cov_threshold, cov_position, idy_threshold, idy_position = \
+            self.filter_columns(filtering)
+        # Same command, but with the results going to the standard output #
+        command = list(self.command)
+        index = command.index('-out')
+        del command[index:index+2]
+        # Check the executable is available #
+        self.check_executable()
+        # Create the output directory if it doesn't exist #
+        self.out_path.directory.create_if_not_exists()
+        # Optionally print the command #
+        if verbose:
+            print("Running BLAST command:\n    %s" % ' '.join(command))
+        # The standard error goes to a file so that the pipe can't block #
+        if isinstance(self._err, str): err = open(self._err, 'w+b')
+        else:                          err = tempfile.TemporaryFile()
+        # Run it, filtering lines as they come #
+        try:
+            with err, open(self.out_path, 'wb', buffering=1<<20) as handle:
+                self.process = subprocess.Popen(command,
+                                                stdout = subprocess.PIPE,
+                                                stderr = err)
+                last = max(cov_position, idy_position) + 1
+                # Don't leave BLAST running if we can't read what it says #
+                try:
+                    with self.process.stdout as blastout:
+                        for line in blastout:
+                            fields = line.split(None, last)
+                            if float(fields[cov_position]) < cov_threshold: continue
+                            if float(fields[idy_position]) < idy_threshold: continue
+                            handle.write(line)
+                except BaseException:
+                    self.terminate()
+                    raise
+                finally:
+                    self.process.wait()
+                # Check it worked #
+                if self.process.returncode != 0:
+                    err.seek(0)
+                    raise subprocess.CalledProcessError(self.process.returncode,
+                                                        command, stderr=err.read())
+        except BaseException:
+            # Partial results are worse than none #
+            if os.path.exists(self.out_path): os.remove(self.out_path)
+            raise
+        # Return #
+        return self.process
+
     #------------------------------- FILTERING -------------------------------#
-    def filter(self, filtering):
+    def filter_columns(self, filtering):
         """
-        We can do some special filtering on the results.
-        For the moment only minimum coverage and minimum identity.
+        Check that the output format contains the columns needed by the
+        `filtering` options. Return the coverage and identity thresholds
+        along with the position of their columns in the output.
         """
         # Conditions #
         if 'min_coverage' in filtering and \
@@ -105,30 +220,84 @@ class BLASTquery(CoreSearch):
            'pident' not in self.params['-outfmt']:
             msg = "Can't filter on minimum identity because it wasn't included."
             raise Exception(msg)
-        # Iterator #
+        # Thresholds and columns #
+        cov_threshold = filtering.get('min_coverage', 0.0) * 100
+        idy_threshold = filtering.get('min_identity', 0.0) * 100
+        outfmt_str    = self.params['-outfmt'].strip('"').split()
+        cov_position  = outfmt_str.index('qcovs')  - 1
+        idy_position  = outfmt_str.index('pident') - 1
+        # Return #
+        return cov_threshold, cov_position, idy_threshold, idy_position
+
+    def filter(self, filtering):
+        """
+        We can do some special filtering on the results.
+        For the moment only minimum coverage and minimum identity.
+        """
+        # Thresholds and columns #
+        cov_threshold, cov_position, idy_threshold, idy_position = \
+            self.filter_columns(filtering)
+        # Only split each line as far as the last column we need #
+        last = max(cov_position, idy_position) + 1
+        # Iterator, works on raw bytes as `float` accepts them directly #
         def filter_lines(blastout):
-            cov_threshold = filtering.get('min_coverage', 0.0) * 100
-            idy_threshold = filtering.get('min_identity', 0.0) * 100
-            outfmt_str    = self.params['-outfmt'].strip('"').split()
-            cov_position  = outfmt_str.index('qcovs')  - 1
-            idy_position  = outfmt_str.index('pident') - 1
             for line in blastout:
-                coverage = float(line.split()[cov_position])
-                identity = float(line.split()[idy_position])
-                if coverage < cov_threshold: continue
-                if identity < idy_threshold: continue
-                else:yield line
-        # Do it #
-        temp_path = new_temp_path()
-        with open(temp_path, 'w') as handle:
-            handle.writelines(filter_lines(self.out_path))
-        os.remove(self.out_path)
-        shutil.move(temp_path, self.out_path)
+                fields = line.split(None, last)
+                if float(fields[cov_position]) < cov_threshold: continue
+                if float(fields[idy_position]) < idy_threshold: continue
+                yield line
+        # Faster iterator, the two columns are parsed in bulk by pandas #
+        # Every line must give exactly one row, or the flags would shift #
+        def filter_lines_pandas(blastout):
+            try:
+                chunks = pandas.read_csv(self.out_path,
+                                         sep              = '\t',
+                                         header           = None,
+                                         usecols          = [cov_position, idy_position],
+                                         dtype            = {cov_position: 'float64',
+                                                             idy_position: 'float64'},
+                                         quoting          = csv.QUOTE_NONE,
+                                         skip_blank_lines = False,
+                                         engine           = 'c',
+                                         chunksize        = 1000000)
+            except pandas.errors.EmptyDataError: return
+            msg = "The rows parsed by pandas don't match the lines of '%s'."
+            for chunk in chunks:
+                keep = (chunk[cov_position] >= cov_threshold) & \
+                       (chunk[idy_position] >= idy_threshold)
+                for flag in keep.values:
+                    line = next(blastout, None)
+                    if line is None: raise Exception(msg % self.out_path)
+                    if flag: yield line
+            if next(blastout, None) is not None: raise Exception(msg % self.out_path)
+        # Pick the iterator depending on what is installed #
+        try:
+            import pandas
+            filter_lines = filter_lines_pandas
+        except ImportError:
+            pass
+        # Do it, next to the output so that the final rename is atomic #
+        temp_path = new_temp_path(dir=str(self.out_path.directory))
+        # The lines are read straight from the mapped pages of the file #
+        with open(self.out_path, 'rb') as blastout, \
+             open(temp_path,     'wb', buffering=1<<20) as handle:
+            if os.fstat(blastout.fileno()).st_size:
+                with mmap.mmap(blastout.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                    handle.writelines(filter_lines(iter(data.readline, b'')))
+        try:
+            os.replace(temp_path, self.out_path)
+        except OSError:
+            os.remove(self.out_path)
+            shutil.move(temp_path, self.out_path)
 
     #----------------------------- PARSE RESULTS -----------------------------#
     @property
     def results(self):
-        """Parse the results and yield biopython SearchIO entries."""
+        """
+        Parse the results and yield biopython SearchIO entries.
+        For JSON output ('-outfmt 15'), yield instead one dictionary per
+        query as found in the 'search' section of the BLAST report.
+        """
         # Import parsing library #
         from Bio import SearchIO
         import Bio.Blast.NCBIXML
@@ -138,25 +307,105 @@ class BLASTquery(CoreSearch):
         # Get the first number of the outfmt #
         outfmt_str = self.params.get('-outfmt', '0').strip('"').split()
         number = outfmt_str[0]
+        # Check for JSON, streamed if possible #
+        if number == '15':
+            with open(self.out_path, 'rb', buffering=1<<20) as handle:
+                try:
+                    import ijson
+                    searches = ijson.items(handle, 'BlastOutput2.item.report.results.search')
+                except ImportError:
+                    import json
+                    reports  = json.load(handle)['BlastOutput2']
+                    searches = (r['report']['results']['search'] for r in reports)
+                for entry in searches:
+                    yield entry
         # Check for XML #
-        if number == '5':
+        elif number == '5':
             with open(self.out_path, 'rb') as handle:
                 for entry in Bio.Blast.NCBIXML.parse(handle):
                     yield entry
         # Check for tabular #
         elif number == '6':
-            with open(self.out_path, 'rt') as handle:
+            with open(self.out_path, 'rt', buffering=1<<20) as handle:
                 for entry in SearchIO.parse(handle, 'blast-tab'):
                     yield entry
         # Check for tabular with comments #
         elif number == '7':
-            with open(self.out_path, 'rt') as handle:
+            with open(self.out_path, 'rt', buffering=1<<20) as handle:
                 for entry in SearchIO.parse(handle, 'blast-tab', comments=True):
                     yield entry
-        # Default case #
+        # Default case, read with a large buffer and the kernel reading ahead #
         else:
-            for line in self.out_path:
-                yield line.split()
+            with open(self.out_path, 'rt', buffering=1<<22) as handle:
+                if hasattr(os, 'posix_fadvise'):
+                    os.posix_fadvise(handle.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+                for line in handle:
+                    yield line.split()
+
+    @property
+    def results_df(self):
+        """
+        Load a tabular output ('-outfmt 6' or '7') in one go as a pandas
+        data frame, with one column per field of the output format. Much
+        faster than `results` when you only need the values.
+        """
+        # Import #
+        import pandas
+        # Check the format #
+        outfmt = self.params.get('-outfmt', '6').strip('"').split()
+        if outfmt[0] not in ('6', '7'):
+            msg = "Only tabular output can be loaded as a data frame, not '%s'."
+            raise Exception(msg % outfmt[0])
+        # Name the columns, expanding the 'std' shortcut #
+        fields  = outfmt[1:] or ['std']
+        columns = [c for f in fields for c in (self.std_columns if f == 'std' else [f])]
+        # Parse #
+        try:
+            return pandas.read_csv(self.out_path,
+                                   sep     = '\t',
+                                   comment = '#',
+                                   header  = None,
+                                   names   = columns,
+                                   engine  = 'c')
+        except pandas.errors.EmptyDataError:
+            return pandas.DataFrame(columns=columns)
+
+    @property
+    def xml_results(self):
+        """
+        Stream an XML output ('-outfmt 5') one query at a time as plain
+        dictionaries. Every <Iteration> element is discarded as soon as it
+        has been converted, so memory use doesn't grow with the file size.
+        """
+        from xml.etree.ElementTree import iterparse
+        iterations = None
+        for event, elem in iterparse(self.out_path, events=('start', 'end')):
+            if event == 'start':
+                if elem.tag == 'BlastOutput_iterations': iterations = elem
+                continue
+            if elem.tag != 'Iteration': continue
+            yield self.convert_iteration(elem)
+            iterations.clear()
+
+    @staticmethod
+    def convert_iteration(iteration):
+        """
+        Turn one <Iteration> element of the BLAST XML into a dictionary.
+        The HSP fields are kept as text, keyed without their 'Hsp_' prefix.
+        """
+        hits = []
+        for hit in iteration.iterfind('Iteration_hits/Hit'):
+            hsps = [{field.tag[4:]: field.text for field in hsp}
+                    for hsp in hit.iterfind('Hit_hsps/Hsp')]
+            hits.append({'id':        hit.findtext('Hit_id'),
+                         'def':       hit.findtext('Hit_def'),
+                         'accession': hit.findtext('Hit_accession'),
+                         'len':       int(hit.findtext('Hit_len')),
+                         'hsps':      hsps})
+        return {'query_id':  iteration.findtext('Iteration_query-ID'),
+                'query_def': iteration.findtext('Iteration_query-def'),
+                'query_len': int(iteration.findtext('Iteration_query-len')),
+                'hits':      hits}
 
 ###############################################################################
 class BLASTdb(FASTA):
@@ -173,8 +422,27 @@ class BLASTdb(FASTA):
         FASTA.__init__(self, fasta_path)
 
     def __bool__(self):
-        """Does the indexed database actually exist?"""
-        return bool(self + '.nsq')
+        """
+        Does the indexed database actually exist? Either the sequence file
+        or, for databases split in several volumes, the alias file.
+        """
+        letter = 'n' if self.seq_type == 'nucl' else 'p'
+        return os.path.exists(self.path + '.%ssq' % letter) or \
+               os.path.exists(self.path + '.%sal' % letter)
+
+    @property
+    def up_to_date(self):
+        """
+        Is the indexed database there and at least as recent as the
+        FASTA file it is built from?
+        """
+        letter = 'n' if self.seq_type == 'nucl' else 'p'
+        source = os.path.getmtime(self.path)
+        def newer(ext):
+            path = self.path + ext % letter
+            return os.path.exists(path) and os.path.getmtime(path) >= source
+        return all(newer(e) for e in ('.%shr', '.%sin', '.%ssq')) or \
+               newer('.%sal')
 
     def create_if_not_exists(self, *args, **kwargs):
         """If the indexed database has not been generated, generate it."""
@@ -187,5 +455,23 @@ class BLASTdb(FASTA):
         options = ['-in', self.path, '-dbtype', self.seq_type]
         # Add a log file #
         if logfile is not None: options += ['-logfile', logfile]
-        # Call the program #
-        sh.makeblastdb(*options, _out=stdout)
\ No newline at end of file
+        # Only one process at a time can build the index #
+        lock_path = self.path + '.lock'
+        while True:
+            lock = open(lock_path, 'w')
+            if fcntl is not None: fcntl.flock(lock, fcntl.LOCK_EX)
+            # The process we waited for might have removed the lock file #
+            try:    current = os.path.samestat(os.fstat(lock.fileno()), os.stat(lock_path))
+            except FileNotFoundError: current = False
+            if current: break
+            lock.close()
+        try:
+            # Another process might have built it while we were waiting #
+            if self.up_to_date: return
+            # Call the program #
+            sh.makeblastdb(*options, _out=stdout)
+        finally:
+            # Don't leave the lock file behind, remove it before releasing it #
+            try:    os.remove(lock_path)
+            except OSError: pass
+            lock.close()
\ No newline at end of file
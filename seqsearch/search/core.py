@@ -8,7 +8,7 @@ Contact at www.sinclair.bio
 """
 
 # Built-in modules #
-import multiprocessing, threading
+import subprocess, multiprocessing, threading
 
 # First party modules #
 from autopaths.file_path import FilePath
@@ -19,7 +19,7 @@ class CoreSearch(object):
     """
     A class to inherit from.
     Contains methods that are common to all search algorithms implementation.
-    Currently: BLASTquery and VSEARCHquery inherit from this.
+    Currently: BLASTquery, VSEARCHquery and HmmQuery inherit from this.
     """
 
     extension = 'out'
@@ -75,8 +75,40 @@ class CoreSearch(object):
             self._err = self.out_path + '.stderr'
 
     #-------------------------------- RUNNING --------------------------------#
+    def launch(self, command):
+        """
+        Run the given command in a subprocess and wait for it to finish.
+        Its standard output and error go to the `_out` and `_err` paths when
+        these are set. Raises a `CalledProcessError` if the command fails.
+        """
+        # Where the output and error streams go #
+        out = open(self._out, 'wb') if isinstance(self._out, str) else self._out
+        err = open(self._err, 'wb') if isinstance(self._err, str) else self._err
+        if out is None: out = subprocess.DEVNULL
+        if err is None: err = subprocess.PIPE
+        # Run it #
+        try:
+            self.process = subprocess.Popen(command, stdout=out, stderr=err)
+            _, stderr = self.process.communicate()
+        except KeyboardInterrupt:
+            self.terminate()
+            raise
+        finally:
+            if isinstance(self._out, str): out.close()
+            if isinstance(self._err, str): err.close()
+        # Check it worked #
+        if self.process.returncode != 0:
+            raise subprocess.CalledProcessError(self.process.returncode,
+                                                command, stderr=stderr)
+        # Return #
+        return self.process
+
     def non_block_run(self):
-        """Special method to run the query in a thread without blocking."""
+        """
+        Special method to run the query in a thread without blocking.
+        To run many queries with a bound on how many execute at once,
+        prefer `ParallelSeqSearch.run_pool`.
+        """
         self.thread = threading.Thread(target=self.run)
         self.thread.daemon = True # So that they die when we die
         self.thread.start()
@@ -84,11 +116,16 @@ class CoreSearch(object):
     def wait(self):
         """
         If you have run the query in a non-blocking way, call this method to pause
-        until the query is finished.
+        until the query is finished. A Ctrl-C stops the underlying process.
         """
         try:
-            # We set a large timeout so that we can Ctrl-C the process
-            self.thread.join(999999999)
+            self.thread.join()
         except KeyboardInterrupt:
-            print("Stopped waiting on BLAST thread number %i" % self.num)
+            self.terminate()
+            print("Stopped waiting on search thread number %s" % self.num)
+
+    def terminate(self):
+        """Stop the search program if it is still running."""
+        process = getattr(self, 'process', None)
+        if process is not None and process.poll() is None: process.terminate()
 
@@ -8,25 +8,29 @@ Contact at www.sinclair.bio
 """
 
 # Built-in modules #
-import warnings, multiprocessing
+import warnings
+from collections import namedtuple
 
 # Internal modules #
+from seqsearch.search.core       import CoreSearch
 from seqsearch.databases.pfam    import pfam
 from seqsearch.databases.tigrfam import tigrfam
 
 # First party modules #
-from fasta import FASTA
-from autopaths.file_path import FilePath
-
-# Third party modules #
-from seqsearch import sh
+from plumbing.cache import property_cached
 
 # Warnings #
 warnings.filterwarnings("ignore", "Bio.SearchIO")
 warnings.filterwarnings("ignore", "BiopythonWarning")
 
+# The nineteen columns of the per-sequence table of hits #
+HmmHit = namedtuple('HmmHit', 'target_name target_accession query_name '
+                              'query_accession full_evalue full_score full_bias '
+                              'dom_evalue dom_score dom_bias exp reg clu ov env '
+                              'dom rep inc description')
+
 ###############################################################################
-class HmmQuery(object):
+class HmmQuery(CoreSearch):
     """An `hmmsearch` job."""
 
     short_name = 'hmmsearch'
@@ -36,10 +40,7 @@ class HmmQuery(object):
     license    = 'GPLv3'
     dependencies = []
 
-    def __nonzero__(self): return bool(self.out_path)
-
-    def __repr__(self):
-        return '<%s object on %s>' % (self.__class__.__name__, self.query)
+    extension = '.hmmout'
 
     def __init__(self, query_path,                    # The input sequences
                  db_path      = pfam.hmm_db,          # The database to search
@@ -49,28 +50,22 @@ class HmmQuery(object):
                  out_path     = None,                 # Where the results will be dropped
                  executable   = None,                 # If you want a specific binary give the path
                  cpus         = None):                # The number of threads to use
+        # Parent constructor #
+        super(HmmQuery, self).__init__(query_path,
+                                       db_path,
+                                       seq_type   = seq_type,
+                                       params     = params,
+                                       algorithm  = 'hmmsearch',
+                                       out_path   = out_path,
+                                       executable = executable,
+                                       cpus       = cpus)
         # Save attributes #
-        self.query      = FASTA(query_path)
-        self.db         = FilePath(db_path)
-        self.params     = params if params else {}
-        self.e_value    = e_value
-        self.seq_type   = seq_type
-        self.executable = FilePath(executable)
-        # Cores to use #
-        if cpus is None: self.cpus = min(multiprocessing.cpu_count(), 32)
-        else:            self.cpus = cpus
+        self.e_value = e_value
         # Auto detect database short name #
         if db_path == 'pfam':    self.db = pfam.hmm_db
         if db_path == 'tigrfam': self.db = tigrfam.hmm_db
-        # Output #
-        if out_path is None:
-            self.out_path = FilePath(self.query.prefix_path + '.hmmout')
-        elif out_path.endswith('/'):
-            self.out_path = FilePath(out_path + self.query.prefix + '.hmmout')
-        else:
-            self.out_path = FilePath(out_path)
 
-    @property
+    @property_cached
     def command(self):
         # Executable #
         if self.executable: cmd = [self.executable.path]
@@ -86,7 +81,7 @@ class HmmQuery(object):
         # Options #
         for k,v in self.params.items(): cmd += [k, v]
         # Return #
-        return map(str, cmd)
+        return tuple(str(x) for x in cmd)
 
     def run(self, cpus=None):
         """Simply run the HMM search locally."""
@@ -101,11 +96,25 @@ class HmmQuery(object):
             warnings.warn(message % self.query, RuntimeWarning)
             return False
         # Do it #
-        sh.Command(self.command[0])(['--cpu', str(cpus)] + self.command[1:])
+        command = self.command
+        return self.launch((command[0], '--cpu', str(cpus)) + command[1:])
 
     @property
     def hits(self):
         if not self.out_path:
             raise Exception("You can't access results from HMMER before running the algorithm.")
         from Bio import SearchIO
-        return SearchIO.read(self.out_path, 'hmmer3-tab')
\ No newline at end of file
+        return SearchIO.read(self.out_path, 'hmmer3-tab')
+
+    def iter_hits(self):
+        """
+        Stream the table of hits one line at a time, yielding `HmmHit`
+        named tuples with every field left as a string. Much lighter than
+        `hits` when you only need to go once through a large output.
+        """
+        if not self.out_path:
+            raise Exception("You can't access results from HMMER before running the algorithm.")
+        with open(self.out_path, 'rt', buffering=1<<20) as handle:
+            for line in handle:
+                if line.startswith('#'): continue
+                yield HmmHit._make(line.rstrip('\n').split(None, 18))
\ No newline at end of file
@@ -8,14 +8,24 @@ Contact at www.sinclair.bio
 """
 
 # Built-in modules #
-import math, subprocess, multiprocessing
+import os, sys, json, math, mmap, shlex, shutil, tempfile, warnings, subprocess, multiprocessing
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 # First party modules #
 from seqsearch.search         import SeqSearch
 from seqsearch.search.blast   import BLASTquery
-from seqsearch.search.vsearch import VSEARCHquery
+from seqsearch.search.vsearch import VSEARCHquery, VSEARCHdb
 from plumbing.cache           import property_cached
+from fasta                    import FASTA
 from fasta.splitable          import SplitableFASTA
+from autopaths.file_path      import FilePath
+
+# Constants #
+MIN_PART_BYTES   = 4 * 1024 * 1024
+PARTS_PER_THREAD = 4
+GZIP_RATIO       = 4
+CPU_COUNT        = multiprocessing.cpu_count()
+SPLIT_INDEX      = 'split_index.json'
 
 ################################################################################
 class ParallelSeqSearch(SeqSearch):
@@ -25,40 +35,128 @@ class ParallelSeqSearch(SeqSearch):
     joining the outputs.
 
     You can specify the number of parts, the size in MB or GB that each part
-    should approximately have, or even how many sequences should be in each
-    part. Specify only one of the three options.
+    should approximately have, how many sequences should be in each part, or
+    how many bases (or residues). Specify only one of the four options. The
+    last one gives balanced pieces when the sequences vary a lot in length,
+    as the time a search takes depends on the number of bases.
+
+    Unless you asked for a number of sequences or bases per part, no part
+    will be smaller than `min_part_bytes` (4 MiB by default, pass 0 to
+    disable): below that, loading the database for every part costs more
+    than the search itself.
+
+    You can place the pieces in a specific directory. With `scratch_dir` the
+    pieces write their results to another directory, typically on a fast
+    local disk, and only the final joined output goes to `out_path`. Pass
+    True to use a fresh temporary directory that is removed afterwards.
+    This has no effect when running on SLURM, as the nodes need to write
+    somewhere that is shared.
+
+    If `slurm_params` are given, the pieces are searched on a SLURM cluster
+    as the tasks of one single array job instead of locally.
+
+    The number of pieces can be much larger than the number of cores: at most
+    `max_concurrent` pieces are searched at the same time (by default
+    `num_threads`), and the next one starts as soon as a slot frees up.
+    If you don't choose, four pieces per thread are made, so that a slow
+    piece doesn't leave the other cores idle at the end of the search.
 
-    You can place the pieces in a specific directory.
+    Each BLAST or VSEARCH piece gets `num_threads // num_parts` threads, at
+    least one and at most four, as BLAST threading stops paying off around
+    there. It is faster to have many single threaded pieces than a few
+    multi-threaded ones.
     """
 
     def __init__(self,
                  input_fasta,
                  database,
-                 num_parts     = None,   # How many fasta pieces should we make
-                 part_size     = None,   # What size in MB should a fasta piece be
-                 seqs_per_part = None,   # How many sequences in one fasta piece
-                 parts_dir     = None,   # If you want a special directory for the fasta pieces
+                 num_parts      = None,  # How many fasta pieces should we make
+                 part_size      = None,  # What size in MB should a fasta piece be
+                 seqs_per_part  = None,  # How many sequences in one fasta piece
+                 parts_dir      = None,  # If you want a special directory for the fasta pieces
+                 max_concurrent = None,  # How many pieces can be searched at the same time
+                 slurm_params   = None,  # Options for `sbatch` if you want to run on a cluster
+                 min_part_bytes = None,  # Don't make fasta pieces smaller than this
+                 bases_per_part = None,  # How many bases in one fasta piece
+                 scratch_dir    = None,  # Where the pieces write their results
                  **kwargs):
         # Determine number of parts #
-        self.num_parts = None
-        # Three possible options #
+        self.num_parts    = None
+        self.bytes_target = None
+        # The size of the input is needed more than once, estimated if gzipped #
+        count_bytes = input_fasta.count_bytes
+        if input_fasta.endswith('.gz'): count_bytes *= GZIP_RATIO
+        # Four possible options #
         if num_parts:
             self.num_parts = num_parts
         if part_size:
             import humanfriendly
             self.bytes_target = humanfriendly.parse_size(part_size)
-            self.num_parts = int(math.ceil(input_fasta.count_bytes / self.bytes_target))
+            self.num_parts = int(math.ceil(count_bytes / self.bytes_target))
         if seqs_per_part:
-            self.num_parts = int(math.ceil(input_fasta.count / seqs_per_part))
-        # Default case #
+            self.num_parts = int(math.ceil(self.count_seqs(input_fasta) / seqs_per_part))
+        self.seqs_per_part = seqs_per_part
+        if bases_per_part and input_fasta.endswith('.gz'):
+            msg = "Can't split the gzipped file '%s' by bases, decompress it first" \
+                  " or use another option."
+            raise Exception(msg % input_fasta)
+        # The offsets are only computed if the last split can't be reused #
+        self.bases_bounds = None
+        if bases_per_part:
+            base_dir = input_fasta + '.parts/' if parts_dir is None else parts_dir
+            previous = self.previous_split(base_dir + SPLIT_INDEX)
+            stat     = os.stat(input_fasta)
+            expected = {'mtime': stat.st_mtime_ns,
+                        'size':  stat.st_size,
+                        'mode':  'bases',
+                        'bases': bases_per_part}
+            if all(previous.get(k) == v for k, v in expected.items()):
+                self.num_parts = len(previous['parts'])
+            else:
+                self.bases_bounds = self.base_bounds(input_fasta, bases_per_part)
+                self.num_parts    = len(self.bases_bounds) - 1
+        self.bases_per_part = bases_per_part
+        # Default case, a few pieces per thread so that the pool can balance #
         if self.num_parts is None:
-            default = min(multiprocessing.cpu_count(), 32)
-            self.num_parts = kwargs.get('num_threads', default)
-            if self.num_parts is True: self.num_parts = default
+            default = min(CPU_COUNT, 32)
+            threads = kwargs.get('num_threads', default)
+            if threads is None or threads is True: threads = default
+            self.num_parts = PARTS_PER_THREAD * threads
+        # Don't make pieces too small to be worth a database load #
+        if min_part_bytes is None: min_part_bytes = MIN_PART_BYTES
+        if not seqs_per_part and not bases_per_part and min_part_bytes:
+            most = max(1, count_bytes // min_part_bytes)
+            self.num_parts = min(self.num_parts, most)
         # In case the user wants a special parts directory #
         self.parts_dir = parts_dir
+        # In case the user wants to run on a cluster #
+        self.slurm_params = slurm_params
+        # In case the user wants the results of the pieces somewhere else #
+        self.scratch_dir = scratch_dir
         # Super #
         SeqSearch.__init__(self, input_fasta, database, **kwargs)
+        # By default run as many pieces at once as we have threads #
+        self.max_concurrent = max_concurrent
+        if self.max_concurrent is None: self.max_concurrent = self.num_threads
+        # Threads given to each piece, BLAST scales poorly beyond four #
+        self.cpus_per_part = max(1, min(4, self.num_threads // self.num_parts))
+        # Check we are not asking for more threads than there are cores #
+        in_flight = min(self.num_parts, self.max_concurrent)
+        if in_flight * self.cpus_per_part > CPU_COUNT:
+            msg = "Running %i pieces at once with %i threads each oversubscribes" \
+                  " the %i cores of this machine."
+            warnings.warn(msg % (in_flight, self.cpus_per_part, CPU_COUNT), RuntimeWarning)
+
+    @staticmethod
+    def count_seqs(fasta):
+        """
+        The number of sequences in `fasta`. If `pyfastx` is installed, its
+        index is used: it is built on the first call, saved next to the
+        file, and reruns get the count without reading the sequences again.
+        """
+        try: import pyfastx
+        except ImportError: return fasta.count
+        return len(pyfastx.Fasta(str(fasta)))
 
     @property_cached
     def splitable(self):
@@ -67,6 +165,260 @@ class ParallelSeqSearch(SeqSearch):
                               self.num_parts,
                               base_dir = self.parts_dir)
 
+    @property
+    def split_index(self):
+        """
+        A small JSON file in the directory of the parts that records which
+        version of the input the parts currently on disk were made from,
+        and how big each of them was when written.
+        """
+        return FilePath(self.splitable.base_dir + SPLIT_INDEX)
+
+    @staticmethod
+    def previous_split(path):
+        """
+        The contents of the split index at `path`, or an empty dictionary if
+        there is none or it can't be read.
+        """
+        try:
+            with open(path) as handle: return json.load(handle)
+        except (OSError, ValueError): return {}
+
+    @property
+    def split_signature(self):
+        """What identifies the input file and the layout of its parts."""
+        stat = os.stat(self.input_fasta)
+        return {'mtime': stat.st_mtime_ns,
+                'size':  stat.st_size,
+                'mode':  self.split_mode,
+                'bases': self.bases_per_part,
+                'parts': [str(p) for p in self.splitable.parts]}
+
+    @property
+    def part_sizes(self):
+        """The current size in bytes of every part, None if one is missing."""
+        try:    return [os.path.getsize(p) for p in self.splitable.parts]
+        except OSError: return None
+
+    def split_input(self):
+        """
+        Chop up the input FASTA, unless the parts already on disk were made
+        from the very same input, with the same layout, and haven't been
+        touched since. Returns False if the split was skipped.
+        """
+        # Check the previous split #
+        signature = self.split_signature
+        previous  = self.previous_split(self.split_index)
+        sizes     = previous.pop('sizes', None)
+        self.split_sizes = self.part_sizes
+        if previous == signature and sizes is not None and sizes == self.split_sizes:
+            return False
+        # The offsets of a split by bases are only computed when needed #
+        if self.split_mode == 'bases' and self.bases_bounds is None:
+            self.bases_bounds = self.base_bounds(self.input_fasta, self.bases_per_part)
+        # Split and remember it #
+        if   self.split_mode == 'seqs':        self.splitable.split()
+        elif self.split_mode == 'bases':       self.split_by_bytes(self.bases_bounds)
+        elif self.input_fasta.endswith('.gz'): self.split_gzip()
+        else:                                  self.split_by_bytes()
+        self.split_sizes = signature['sizes'] = self.part_sizes
+        with open(self.split_index, 'w') as handle: json.dump(signature, handle)
+        return True
+
+    @property
+    def split_mode(self):
+        """How the input is split: by 'seqs', by 'bases' or by 'bytes'."""
+        if self.seqs_per_part:  return 'seqs'
+        if self.bases_per_part: return 'bases'
+        return 'bytes'
+
+    def split_by_bytes(self, bounds=None):
+        """
+        Chop up the input FASTA into contiguous pieces of roughly equal size
+        in bytes. The input is memory mapped, every cut is moved forward to
+        the start of the next record with a `find` on the raw bytes, and
+        then all the pieces are written out at the same time by several
+        threads. Each thread first asks the kernel to prefetch its own
+        window of the input, then has it copied to the piece with
+        `copy_file_range` so the bytes never transit through python. Where
+        that isn't available the window is written from the mapped pages.
+        If `bounds` are given, the pieces are cut at these offsets instead.
+        """
+        parts = self.splitable.parts
+        with open(self.input_fasta, 'rb') as handle:
+            size = os.fstat(handle.fileno()).st_size
+            # An empty file can't be mapped #
+            if size == 0: data = b''
+            else:         data = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+            if hasattr(mmap, 'MADV_SEQUENTIAL') and size:
+                data.madvise(mmap.MADV_SEQUENTIAL)
+            view = memoryview(data)
+            try:
+                # Where every piece starts and ends #
+                if bounds is None:
+                    bounds = [self.record_start(data, size * i // len(parts))
+                              for i in range(len(parts))] + [size]
+                # Write one piece, asking the kernel to read ahead its window #
+                def write_part(i):
+                    start = bounds[i] - bounds[i] % mmap.PAGESIZE
+                    if hasattr(mmap, 'MADV_WILLNEED') and bounds[i+1] > start:
+                        data.madvise(mmap.MADV_WILLNEED, start, bounds[i+1] - start)
+                    parts[i].directory.create_if_not_exists()
+                    with open(parts[i], 'wb', buffering=0) as dest:
+                        offset, end = bounds[i], bounds[i+1]
+                        while offset < end:
+                            try:
+                                sent = os.copy_file_range(handle.fileno(), dest.fileno(),
+                                                          end - offset, offset)
+                            except (AttributeError, OSError):
+                                sent = 0
+                            # No progress from the kernel, copy the mapped pages #
+                            if not sent: sent = dest.write(view[offset:end])
+                            offset += sent
+                # Write all pieces, with a bounded number of threads #
+                workers = max(1, min(len(parts), CPU_COUNT, 32))
+                with ThreadPoolExecutor(max_workers=workers) as executor:
+                    list(executor.map(write_part, range(len(parts))))
+                # The pieces will be read, but not the input, free its cache #
+                self.advise(handle, 'DONTNEED')
+            finally:
+                view.release()
+                if size: data.close()
+
+    def split_gzip(self):
+        """
+        Chop up a gzipped input FASTA in a single streaming pass, without
+        ever writing the decompressed file to disk. The decompressed size
+        is estimated from the compression ratio seen so far, and every
+        piece is closed at the first record after it reaches its share of
+        it. The `isal` library is used when installed, as it decompresses
+        several times faster than the standard `gzip` module.
+        """
+        try:                from isal import igzip as gzip
+        except ImportError: import gzip
+        parts = self.splitable.parts
+        for part in parts: part.directory.create_if_not_exists()
+        with open(self.input_fasta, 'rb') as raw, gzip.open(raw, 'rb') as handle:
+            total = os.fstat(raw.fileno()).st_size
+            index, size, written, previous = 0, 0, 0, b''
+            dest = open(parts[0], 'wb')
+            try:
+                for block in iter(lambda: handle.read(1 << 20), b''):
+                    written += len(block)
+                    share    = written * total / max(raw.tell(), 1) / len(parts)
+                    start    = 0
+                    # Close the current piece where it reaches its share #
+                    while index < len(parts) - 1 and size + len(block) - start >= share:
+                        offset = start + max(0, int(share - size))
+                        if offset == 0 and previous == b'\n' and block[:1] == b'>':
+                            cut = 0
+                        else:
+                            found = block.find(b'\n>', max(offset - 1, start))
+                            if found == -1: break
+                            cut = found + 1
+                        dest.write(block[start:cut])
+                        dest.close()
+                        index += 1
+                        dest   = open(parts[index], 'wb')
+                        size, start = 0, cut
+                    dest.write(block[start:])
+                    size    += len(block) - start
+                    previous = block[-1:]
+            finally:
+                dest.close()
+        # Pieces that got nothing still have to exist #
+        for part in parts[index+1:]: open(part, 'wb').close()
+
+    @staticmethod
+    def record_start(data, offset):
+        """
+        Find the position of the first FASTA record that starts at or after
+        `offset` in `data`, or the end of `data` if there is none.
+        """
+        if offset == 0: return 0
+        # Start one byte early to catch a record starting exactly at offset #
+        found = data.find(b'\n>', offset - 1)
+        return len(data) if found == -1 else found + 1
+
+    def base_bounds(self, path, bases_per_part, window=1<<26):
+        """
+        Go once through the FASTA at `path` and return the offsets at which
+        pieces holding about `bases_per_part` bases each should start,
+        followed by the size of the file. A new piece is started as soon
+        as the current one reaches the target. Line breaks are not counted.
+        They are counted in one `window` of the file at a time, instead of
+        copying every record out of the mapped pages.
+        """
+        with open(path, 'rb') as handle:
+            size = os.fstat(handle.fileno()).st_size
+            if size == 0: return [0, 0]
+            with mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                bounds, bases, start = [0], 0, 0
+                low, block = 0, b''
+                while start < size:
+                    end    = self.record_start(data, start + 1)
+                    header = data.find(b'\n', start, end)
+                    if header != -1:
+                        if end > low + len(block):
+                            low   = header + 1
+                            block = data[low:max(end, low + window)]
+                        breaks = block.count(b'\n', header + 1 - low, end - low)
+                        bases += end - header - 1 - breaks
+                    if bases >= bases_per_part and end < size:
+                        bounds.append(end)
+                        bases = 0
+                    start = end
+        return bounds + [size]
+
+    @property_cached
+    def query_parts(self):
+        """
+        The FASTA files to search, one per piece of the input. When a target
+        size was given, neighbouring pieces smaller than a quarter of it are
+        first merged together, as every search pays the full cost of loading
+        the database. Only neighbours are merged so that the joined output
+        stays in the order of the input.
+        """
+        # Chop up the FASTA, the only place where it is done #
+        self.split_input()
+        parts = self.splitable.parts
+        # The sizes were already measured when checking the split #
+        sizes = dict(zip(parts, self.split_sizes))
+        self.query_sizes = {str(p): sizes[p] for p in parts}
+        if not self.bytes_target: return parts
+        # Fill bins of neighbouring small pieces up to the target size #
+        bins, current, total = [], [], 0
+        for p in parts:
+            if sizes[p] >= self.bytes_target / 4:
+                if current: bins.append(current)
+                bins.append([p])
+                current, total = [], 0
+                continue
+            current.append(p)
+            total += sizes[p]
+            if total >= self.bytes_target:
+                bins.append(current)
+                current, total = [], 0
+        if current: bins.append(current)
+        # Merge every bin into one file #
+        merged = []
+        for pieces in bins:
+            if len(pieces) == 1:
+                merged.append(pieces[0])
+                continue
+            result = FASTA(pieces[0].prefix_path + '_merged.fasta')
+            with open(result, 'wb') as dest:
+                for p in pieces:
+                    with open(p, 'rb') as source:
+                        self.advise(source, 'SEQUENTIAL')
+                        shutil.copyfileobj(source, dest, 1 << 20)
+                        self.advise(source, 'DONTNEED')
+            result.num = pieces[0].num
+            self.query_sizes[str(result)] = sum(sizes[p] for p in pieces)
+            merged.append(result)
+        # Return #
+        return merged
+
     @property
     def queries(self):
         """A list of all the queries to run."""
@@ -75,23 +427,178 @@ class ParallelSeqSearch(SeqSearch):
         raise NotImplemented(self.algorithm)
 
     def join_outputs(self):
-        """Join the outputs."""
-        all_files = ' '.join(q.out_path for q in self.queries)
-        subprocess.check_call('cat %s > %s' % (all_files, self.out_path))
+        """
+        Join the outputs by concatenating them in the order of the queries.
+        Done in python, so that neither a shell nor the command line length
+        limit are involved, however many parts there are.
+        """
+        flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC
+        dest  = os.open(self.out_path, flags, 0o644)
+        try:
+            for query in self.queries:
+                with open(query.out_path, 'rb') as source:
+                    self.advise(source, 'SEQUENTIAL')
+                    self.append_file(source, dest)
+                    # We won't read this part again, free the page cache #
+                    self.advise(source, 'DONTNEED')
+        finally:
+            os.close(dest)
+
+    @staticmethod
+    def advise(handle, advice):
+        """
+        Pass an access pattern advice such as 'SEQUENTIAL' or 'DONTNEED'
+        about the whole of an open file to the kernel, where supported.
+        """
+        try: os.posix_fadvise(handle.fileno(), 0, 0, getattr(os, 'POSIX_FADV_' + advice))
+        except (AttributeError, OSError): pass
+
+    @staticmethod
+    def append_file(source, dest):
+        """
+        Append the contents of the open file `source` to the file descriptor
+        `dest`. On Linux `sendfile` lets the kernel copy the pages directly,
+        without them ever transiting through python.
+        """
+        if hasattr(os, 'sendfile') and sys.platform.startswith('linux'):
+            size, offset = os.fstat(source.fileno()).st_size, 0
+            while offset < size:
+                sent = os.sendfile(dest, source.fileno(), offset, size - offset)
+                if sent == 0: break
+                offset += sent
+        else:
+            with os.fdopen(dest, 'wb', closefd=False) as handle:
+                shutil.copyfileobj(source, handle, 1 << 20)
 
     #-------------------------------- RUNNING --------------------------------#
+    def run(self):
+        """Run the search, on SLURM if `slurm_params` were given."""
+        if self.slurm_params is not None: return self.run_slurm()
+        return self.run_local()
+
+    def prepare_database(self):
+        """
+        Build the database index once, before any of the pieces are searched,
+        so that they don't all race to create it. A plain FASTA searched with
+        VSEARCH gets its '.udb' index built next to it. The VSEARCH index is
+        then read ahead, so that all the pieces share it from the page cache.
+        """
+        database = self.database
+        if self.algorithm == 'vsearch' and not hasattr(database, 'create_if_not_exists'):
+            if FilePath(database).extension == 'fasta':
+                database = VSEARCHdb(FilePath(database).replace_extension('udb'))
+        if hasattr(database, 'create_if_not_exists'):
+            database.create_if_not_exists()
+        if self.algorithm == 'vsearch' and isinstance(database, VSEARCHdb):
+            with open(database.replace_extension('udb'), 'rb') as handle:
+                self.advise(handle, 'WILLNEED')
+
     def run_local(self):
         """Run the search locally."""
-        # Chop up the FASTA #
-        self.splitable.split()
+        # Index the database #
+        self.prepare_database()
+        # Too many copies of the database to fit in memory, don't split #
+        if self.vsearch_too_big: return self.vsearch_query.run()
+        # Chop up the FASTA, once, and make one query per piece #
+        queries = self.queries
         # Case only one query #
-        if len(self.queries) == 1: self.queries[0].run()
+        if len(queries) == 1: queries[0].run()
         # Case many queries #
-        else:
-            for query in self.queries: query.non_block_run()
-            for query in self.queries: query.wait()
+        else: self.run_pool(queries)
         # Join the results #
         self.join_outputs()
+        # Remove the temporary directory we made #
+        if self.scratch_dir is True and self.part_out_dir:
+            shutil.rmtree(self.part_out_dir, ignore_errors=True)
+
+    @property
+    def vsearch_too_big(self):
+        """
+        Would the VSEARCH pieces running side by side fill the memory?
+        Every vsearch process loads its own copy of the database. Past 70%
+        of the physical memory it is better to run one single process on
+        the whole input with all the threads, sharing one copy.
+        """
+        if self.algorithm != 'vsearch': return False
+        # The database, or its index if it has one #
+        database = FilePath(self.database)
+        udb      = database.replace_extension('udb')
+        if udb.exists: database = udb
+        if not database.exists: return False
+        # The physical memory, where the platform tells us #
+        try: memory = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+        except (AttributeError, ValueError, OSError): return False
+        # Compare #
+        in_flight = min(self.num_parts, self.max_concurrent)
+        return os.path.getsize(database) * in_flight > 0.7 * memory
+
+    def run_pool(self, queries):
+        """
+        Run the given queries with at most `max_concurrent` of them executing
+        at the same time. Each query launches its own external process, so
+        threads are enough to keep them all busy. As soon as one of the
+        queries fails, the ones that have not started yet are cancelled, the
+        programs still running are terminated, and the exception is raised.
+        The biggest pieces are started first, so that the small ones fill
+        in the gaps at the end instead of a big one running alone.
+        """
+        workers = max(1, min(self.max_concurrent, len(queries)))
+        size_of = lambda q: self.query_sizes.get(str(q.query), 0)
+        queries = sorted(queries, key=size_of, reverse=True)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(q.run) for q in queries]
+            try:
+                for future in as_completed(futures): future.result()
+            except BaseException:
+                for future in futures: future.cancel()
+                for query in queries: query.terminate()
+                raise
+
+    def run_slurm(self):
+        """
+        Run the search on a SLURM cluster as one array job where every task
+        searches one piece of the input. This makes a single submission
+        instead of one per piece. Blocks until all the tasks are done and
+        then joins the outputs. The `slurm_params` are passed on to `sbatch`
+        as long options, for instance {'time': '2:00:00', 'mem': '8G'}.
+        """
+        # Index the database #
+        self.prepare_database()
+        # Chop up the FASTA, once, and make one query per piece #
+        queries = self.queries
+        # Create the output directories #
+        for query in queries: query.out_path.directory.create_if_not_exists()
+        # The script picks its command line with the task number #
+        commands = '\n'.join(shlex.quote(shlex.join(q.command)) for q in queries)
+        script   = FilePath(self.out_path.prefix_path + '.slurm.sh')
+        with open(script, 'w') as handle:
+            handle.write('#!/bin/bash\n')
+            handle.write('COMMANDS=(\n%s\n)\n' % commands)
+            handle.write('eval "${COMMANDS[$SLURM_ARRAY_TASK_ID]}"\n')
+        # Options #
+        params = {'cpus-per-task': queries[0].cpus}
+        params.update(self.slurm_params)
+        options = ['--%s=%s' % (k, v) for k, v in params.items()]
+        # Submit and wait for all the tasks to finish #
+        subprocess.run(['sbatch', '--wait',
+                        '--array=0-%i' % (len(queries) - 1),
+                        '--open-mode=append',
+                        '--output=' + self.out_path.prefix_path + '.slurm_%a.out']
+                       + options + [str(script)], check=True)
+        # Join the results #
+        self.join_outputs()
+
+    @property_cached
+    def part_out_dir(self):
+        """
+        The directory where the pieces write their results, or None to
+        leave them next to the pieces themselves.
+        """
+        if not self.scratch_dir or self.slurm_params is not None: return None
+        if self.scratch_dir is True: path = tempfile.mkdtemp(prefix='seqsearch_')
+        else:                        path = str(self.scratch_dir)
+        os.makedirs(path, exist_ok=True)
+        return path.rstrip('/') + '/'
 
     #-------------------------- BLAST IMPLEMENTATION -------------------------#
     @property_cached
@@ -105,12 +612,19 @@ class ParallelSeqSearch(SeqSearch):
                            seq_type     = self.seq_type,
                            params       = self.blast_params,
                            algorithm    = blast_algo,
-                           cpus         = 1,
-                           num          = p.num) for p in self.splitable.parts]
+                           cpus         = self.cpus_per_part,
+                           out_path     = self.part_out_dir,
+                           num          = p.num) for p in self.query_parts]
 
     #-------------------------- VSEARCH IMPLEMENTATION -------------------------#
     @property_cached
     def vsearch_queries(self):
         """Make all VSEARCH search objects."""
-        return [VSEARCHquery(p, self.database, self.vsearch_params)
-                for p in self.splitable.parts]
\ No newline at end of file
+        return [VSEARCHquery(query_path = p,
+                             db_path    = self.database,
+                             seq_type   = self.seq_type,
+                             params     = self.vsearch_params,
+                             algorithm  = "usearch_global",
+                             cpus       = self.cpus_per_part,
+                             out_path   = self.part_out_dir,
+                             num        = p.num) for p in self.query_parts]
\ No newline at end of file
@@ -8,9 +8,11 @@ Contact at www.sinclair.bio
 """
 
 # Built-in modules #
+import os
 
 # Internal modules #
 from autopaths.file_path import FilePath
+from plumbing.cache      import property_cached
 from seqsearch.search.core import CoreSearch
 
 # Third party modules #
@@ -44,24 +46,35 @@ class VSEARCHquery(CoreSearch):
 
     extension = 'vsearchout'
 
-    @property
+    # The columns of the blast6 output with their types #
+    blast6_dtype = [('qseqid', 'U128'), ('sseqid',   'U128'), ('pident',  'f4'),
+                    ('length', 'i4'),   ('mismatch', 'i4'),   ('gapopen', 'i4'),
+                    ('qstart', 'i4'),   ('qend',     'i4'),   ('sstart',  'i4'),
+                    ('send',   'i4'),   ('evalue',   'f8'),   ('bitscore', 'f4')]
+
+    @property_cached
     def command(self):
         # Executable #
         if self.executable: cmd = [self.executable.path]
         else:               cmd = ['vsearch']
+        # Use the prebuilt index of the database when there is one #
+        udb = self.db.replace_extension('udb')
+        db  = udb if udb.exists else self.db
         # Other parameters
         cmd += ['--usearch_global', self.query,
-                '--db',             self.db,
+                '--db',             db,
                 '--blast6out',      self.out_path,
                 '--threads',        self.cpus]
         # Options #
         for k,v in self.params.items(): cmd += [k, v]
         # Return #
-        return list(map(str, cmd))
+        return tuple(str(x) for x in cmd)
 
     #-------------------------------- RUNNING --------------------------------#
     def run(self, verbose=False):
         """Simply run the VSEARCH search locally."""
+        # The command is only built once #
+        command = self.command
         # Check the executable is available #
         if self.executable:
             self.executable.must_exist()
@@ -72,10 +85,9 @@ class VSEARCHquery(CoreSearch):
         self.out_path.directory.create_if_not_exists()
         # Optionally print the command #
         if verbose:
-            print("Running VSEARCH command:\n    %s" % ' '.join(self.command))
+            print("Running VSEARCH command:\n    %s" % ' '.join(command))
         # Run it #
-        cmd    = sh.Command(self.command[0])
-        result = cmd(self.command[1:], _out=self._out, _err=self._err)
+        result = self.launch(command)
         # Return #
         return result
 
@@ -107,11 +119,38 @@ class VSEARCHquery(CoreSearch):
         # Avoid the warning #
         import warnings
         warnings.filterwarnings("ignore", 'BiopythonDeprecationWarning')
-        # Iterate over lines #
-        with open(self.out_path, 'rt') as handle:
+        # Iterate over lines, with a large buffer and the kernel reading ahead #
+        with open(self.out_path, 'rt', buffering=1<<20) as handle:
+            if hasattr(os, 'posix_fadvise'):
+                os.posix_fadvise(handle.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
             for entry in SearchIO.parse(handle, 'blast-tab'):
                 yield entry
 
+    def results_as_array(self, columns=None):
+        """
+        Load the whole output in one go as a numpy structured array, with
+        one named field per column of the blast6 format. Much faster than
+        `results` when you only need to filter or sum over the values.
+        You can restrict the loading to some `columns`, for instance
+        ['pident', 'evalue']. Identifiers longer than 128 characters are
+        truncated.
+        """
+        # Import #
+        import numpy
+        # Pick the columns #
+        names = [name for name, kind in self.blast6_dtype]
+        if columns is None: columns = names
+        usecols = [names.index(c) for c in columns]
+        dtype   = [self.blast6_dtype[i] for i in usecols]
+        # An empty output, numpy would warn about it #
+        if os.path.getsize(self.out_path) == 0: return numpy.empty(0, dtype=dtype)
+        # Parse #
+        return numpy.loadtxt(self.out_path,
+                             dtype     = dtype,
+                             delimiter = '\t',
+                             usecols   = usecols,
+                             ndmin     = 1)
+
 ###############################################################################
 class VSEARCHdb(FilePath):
     """A VSEARCH database one can search against."""